@@ -1,14 +1,49 @@
 import numpy as np
 import pandas as pd
 from enum import Enum
-from scipy.stats import wilcoxon
+from scipy.stats import rankdata, wilcoxon
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
 
 from catboost import CatboostError
 from catboost.core import metric_description_or_str_to_str
 
 
+def _build_wilcoxon_exact_cdfs(max_size):
+    cdfs = {}
+    for size in range(1, max_size + 1):
+        # counts[w] is the number of rank subsets of {1..size} summing to w
+        counts = np.zeros(size * (size + 1) // 2 + 1)
+        counts[0] = 1.0
+        for rank in range(1, size + 1):
+            counts[rank:] = counts[rank:] + counts[:-rank]
+        cdfs[size] = np.cumsum(counts) / 2 ** size
+    return cdfs
+
+
+_WILCOXON_EXACT_MAX_SIZE = 20
+_WILCOXON_EXACT_CDFS = _build_wilcoxon_exact_cdfs(_WILCOXON_EXACT_MAX_SIZE)
+
+
 def calc_wilcoxon_test(baseline, test):
-    stat, pvalue = wilcoxon(baseline, test, zero_method="pratt")
+    diff = np.asarray(baseline, dtype=np.float64) - np.asarray(test, dtype=np.float64)
+    abs_diff = np.abs(diff)
+    # the precomputed null distribution is valid only without zeros and ties,
+    # which is the typical case for per-fold metric scores
+    if len(diff) <= _WILCOXON_EXACT_MAX_SIZE and diff.all() and np.unique(abs_diff).size == len(diff):
+        ranks = rankdata(abs_diff)
+        stat = min(ranks[diff > 0].sum(), ranks[diff < 0].sum())
+        pvalue = min(1.0, 2.0 * _WILCOXON_EXACT_CDFS[len(diff)][int(stat)])
+    else:
+        stat, pvalue = wilcoxon(baseline, test, zero_method="pratt")
     if pvalue < 0.5:
         pvalue = 1.0 - pvalue
     return pvalue, stat
@@ -45,7 +80,68 @@ class ScoreConfig:
         self.overfit_overfit_iterations_info = overfit_iterations_info
 
 
-def calc_bootstrap_ci_for_mean(samples, level=0.05, tries=999):
+_PLOTLY_GRAPH_OBJS = None
+
+
+def _get_plotly_graph_objs():
+    global _PLOTLY_GRAPH_OBJS
+    if _PLOTLY_GRAPH_OBJS is None:
+        import plotly.graph_objs
+        _PLOTLY_GRAPH_OBJS = plotly.graph_objs
+    return _PLOTLY_GRAPH_OBJS
+
+
+def _make_learning_curves_layout(go, title):
+    return go.Layout(
+        title=title,
+        hovermode='closest',
+        xaxis=dict(
+            title='Iteration',
+            ticklen=5,
+            zeroline=False,
+            gridwidth=2,
+        ),
+        yaxis=dict(
+            title='Metric',
+            ticklen=5,
+            gridwidth=2,
+        ),
+        showlegend=True
+    )
+
+
+_BOOTSTRAP_RNG = np.random.default_rng()
+
+
+def _calc_bootstrap_means_numpy(samples, tries):
+    size = len(samples)
+    if not np.isfinite(samples).all():
+        # a zero count times an inf sample would turn the whole resample mean
+        # into nan, so non-finite samples are resampled by gathering instead
+        return samples[_BOOTSTRAP_RNG.integers(0, size, size=(tries, size))].mean(axis=1)
+    # the mean of a resample is (counts . samples) / size with
+    # counts ~ Multinomial(size, 1/size), so one matrix-vector product
+    # gives all bootstrap means at once
+    counts = _BOOTSTRAP_RNG.multinomial(size, np.full(size, 1.0 / size), size=tries).astype(np.float64)
+    return counts.dot(samples) / size
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def _calc_bootstrap_means(samples, tries):
+        size = len(samples)
+        means = np.empty(tries)
+        for try_index in prange(tries):
+            total = 0.0
+            for _ in range(size):
+                total += samples[np.random.randint(0, size)]
+            means[try_index] = total / size
+        return means
+else:
+    _calc_bootstrap_means = _calc_bootstrap_means_numpy
+
+
+def calc_bootstrap_ci_for_mean(samples, level=0.05, tries=999, seed=None):
     """
     Count confidence intervals for difference each two samples.
 
@@ -53,22 +149,36 @@ def calc_bootstrap_ci_for_mean(samples, level=0.05, tries=999):
         :param samples: samples
         :param level: (float) Level for the confidence interval.
         :param tries: bootstrap samples to use
+        :param seed: reseed the shared resampling generator for reproducibility, optional
         :return: (left, right) border of confidence interval
 
     """
+    global _BOOTSTRAP_RNG
+    if seed is not None:
+        _BOOTSTRAP_RNG = np.random.default_rng(seed)
 
-    if not (samples == 0).all():
-        samples = np.array(samples)
-        means = []
-        for i in range(0, tries):
-            resample = np.random.choice(samples, len(samples))
-            means.append(np.mean(resample))
-        means = sorted(means)
-        left = means[int(tries * (level / 2))]
-        right = means[int(tries * (1.0 - level / 2))]
-        return left, right
-    else:
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
         return 0, 0
+    if np.isfinite(samples).all():
+        mean = samples.mean()
+        if samples.std() <= 1e-15 * max(abs(mean), 1.0):
+            # every resample of a (numerically) constant sample has the same mean
+            return mean, mean
+
+    if seed is not None:
+        # the parallel numba kernel draws from per-thread random states that
+        # cannot be seeded deterministically, so seeded calls always resample
+        # through the shared generator
+        means = _calc_bootstrap_means_numpy(samples, tries)
+    else:
+        means = _calc_bootstrap_means(samples, tries)
+    left_index = int(tries * (level / 2))
+    right_index = int(tries * (1.0 - level / 2))
+    # means is a fresh buffer, so the order statistics can be selected
+    # in place without the copy np.partition would make
+    means.partition([left_index, right_index])
+    return means[left_index], means[right_index]
 
 
 class CaseEvaluationResult:
@@ -80,10 +190,14 @@ class CaseEvaluationResult:
         self._case = case
         self._metric_description = metric_description
 
-        self._fold_metric = pd.Series()
-        self._fold_metric_iteration = pd.Series()
+        self._fold_metric = dict()
+        self._fold_metric_iteration = dict()
         self._fold_curves = dict()
 
+        self._best_metrics = None
+        self._best_iterations = None
+        self._fit_counts = dict()
+
         self._eval_step = eval_step
 
     def _add(self, model, learning_curve):
@@ -93,12 +207,15 @@ class CaseEvaluationResult:
         fold_id = model.get_fold_id()
 
         self._fold_curves[fold_id] = learning_curve
-        score = max(learning_curve) if self._metric_description.is_max_optimal() else min(learning_curve)
-        position = np.argmax(learning_curve) if self._metric_description.is_max_optimal() else np.argmin(
-            learning_curve)
+        curve = np.asarray(learning_curve)
+        position = int(curve.argmax() if self._metric_description.is_max_optimal() else curve.argmin())
+        score = curve[position]
 
-        self._fold_metric.set_value(label=fold_id, value=score)
-        self._fold_metric_iteration.set_value(label=fold_id, value=position)
+        self._fold_metric[fold_id] = score
+        self._fold_metric_iteration[fold_id] = position
+        self._best_metrics = None
+        self._best_iterations = None
+        self._fit_counts = dict()
 
     def get_case(self):
         """
@@ -123,13 +240,17 @@ class CaseEvaluationResult:
         """
         :return: pandas Series with best iterations on all folds
         """
-        return self._fold_metric_iteration
+        if self._best_iterations is None:
+            self._best_iterations = pd.Series(self._fold_metric_iteration)
+        return self._best_iterations
 
     def get_best_metrics(self):
         """
         :return: pandas series with best metric values
         """
-        return self._fold_metric
+        if self._best_metrics is None:
+            self._best_metrics = pd.Series(self._fold_metric)
+        return self._best_metrics
 
     def get_fold_curve(self, fold):
         """
@@ -158,17 +279,15 @@ class CaseEvaluationResult:
         :param underfit_border: border, after which there should be no best_metric_scores
         :return: #models with best_metric > underfit_border * iter_count, #models, with best_metric > overfit_border
         """
-        count_overfitting = 0
-        count_underfitting = 0
-
-        for fold_id, fold_curve in self._fold_curves.items():
-            best_score_position = self._fold_metric_iteration[fold_id]
-            best_model_size_fraction = best_score_position * 1.0 / len(fold_curve)
-            if best_model_size_fraction > overfit_border:
-                count_underfitting += 1
-            elif best_model_size_fraction < underfit_border:
-                count_overfitting += 1
-        return count_overfitting, count_underfitting
+        borders = (overfit_border, underfit_border)
+        if borders not in self._fit_counts:
+            positions = np.array([self._fold_metric_iteration[fold_id] for fold_id in self._fold_curves])
+            lengths = np.array([len(fold_curve) for fold_curve in self._fold_curves.values()], dtype=np.float64)
+            fractions = positions / lengths
+            count_underfitting = int((fractions > overfit_border).sum())
+            count_overfitting = int(((fractions <= overfit_border) & (fractions < underfit_border)).sum())
+            self._fit_counts[borders] = (count_overfitting, count_underfitting)
+        return self._fit_counts[borders]
 
     def estimate_fit_quality(self):
         """
@@ -186,7 +305,7 @@ class CaseEvaluationResult:
         :param offset: First iteration to plot
         :return: plotly Figure with learning curves for each fold
         """
-        import plotly.graph_objs as go
+        go = _get_plotly_graph_objs()
 
         traces = []
 
@@ -197,27 +316,12 @@ class CaseEvaluationResult:
             else:
                 first_idx = int(len(scores_curve) * 0.1)
 
-            traces.append(go.Scatter(x=[i * int(self._eval_step) for i in range(first_idx, len(scores_curve))],
-                                     y=scores_curve[first_idx:],
+            traces.append(go.Scatter(x=np.arange(first_idx, len(scores_curve)) * int(self._eval_step),
+                                     y=np.asarray(scores_curve)[first_idx:],
                                      mode='lines',
                                      name='Fold #{}'.format(fold)))
 
-        layout = go.Layout(
-            title='Learning curves for case {}'.format(self._case),
-            hovermode='closest',
-            xaxis=dict(
-                title='Iteration',
-                ticklen=5,
-                zeroline=False,
-                gridwidth=2,
-            ),
-            yaxis=dict(
-                title='Metric',
-                ticklen=5,
-                gridwidth=2,
-            ),
-            showlegend=True
-        )
+        layout = _make_learning_curves_layout(go, 'Learning curves for case {}'.format(self._case))
         fig = go.Figure(data=traces, layout=layout)
         return fig
 
@@ -235,6 +339,10 @@ class MetricEvaluationResult:
 
         self._case_results = dict()
         self._case_comparisons = dict()
+        # wilcoxon results are symmetric in the case pair and fold scores are
+        # immutable after construction, so pairwise tests are computed once
+        # and survive baseline or score config changes
+        self._pairwise_wilcoxon = dict()
         self._cases = [case_result.get_case() for case_result in case_results]
 
         for case_result in case_results:
@@ -266,53 +374,109 @@ class MetricEvaluationResult:
             self._config = config
             self.__clear_comparisons()
 
+    def _calc_pairwise_wilcoxon(self, case, other_case, series_name, baseline, test):
+        key = (frozenset((case, other_case)), series_name)
+        if key not in self._pairwise_wilcoxon:
+            self._pairwise_wilcoxon[key] = calc_wilcoxon_test(baseline, test)
+        return self._pairwise_wilcoxon[key]
+
+    def _warm_pairwise_wilcoxon(self, baseline_case, series_name, baseline, tests):
+        missing = [(case, test) for (case, test) in tests
+                   if (frozenset((baseline_case, case)), series_name) not in self._pairwise_wilcoxon]
+        if len(missing) < 2:
+            return
+        baseline = np.asarray(baseline, dtype=np.float64)
+        stacked = np.stack([np.asarray(test, dtype=np.float64) for (_, test) in missing])
+        try:
+            # one vectorized call ranks all case pairs at once
+            stats, pvalues = wilcoxon(np.broadcast_to(baseline, stacked.shape), stacked,
+                                      zero_method="pratt", axis=1)
+        except TypeError:
+            # scipy without axis support, the per-pair calls will fill the cache
+            return
+        pvalues = np.where(pvalues < 0.5, 1.0 - pvalues, pvalues)
+        for ((case, _), pvalue, stat) in zip(missing, pvalues, stats):
+            self._pairwise_wilcoxon[(frozenset((baseline_case, case)), series_name)] = (float(pvalue), float(stat))
+
     def _compute_case_result_table(self, baseline_case):
-        result = pd.DataFrame()
         baseline_scores = self._case_results[baseline_case].get_best_metrics()
         baseline_iters = self._case_results[baseline_case].get_best_iterations()
 
-        for (case, case_result) in self._case_results.items():
-            if case != baseline_case:
-                test_scores = case_result.get_best_metrics()
-                pvalue, statistic = calc_wilcoxon_test(baseline_scores, test_scores)
-
-                diff = (baseline_scores - test_scores)
-                if self._score_config.type == ScoreType.Rel:
-                    diff = diff / baseline_scores.abs()
-                if self._metric_description.is_max_optimal():
-                    diff = -diff
-                mean_diff = diff.mean()
-
-                left_quantile, right_quantile = calc_bootstrap_ci_for_mean(diff,
-                                                                           self._score_config.interval_level)
-
-                # result.set_value(index=case, col="Statistic", value=statistic)
-                result.set_value(index=case, col="PValue", value=pvalue)
-                result.set_value(index=case, col="Score", value=mean_diff * self._score_config.multiplier)
-
-                left_quantile_title = "Quantile {}".format(self._score_config.score_level / 2)
-                right_quantile_title = "Quantile {}".format(1.0 - self._score_config.score_level / 2)
-
-                result.set_value(index=case, col=left_quantile_title,
-                                 value=left_quantile * self._score_config.multiplier)
-                result.set_value(index=case, col=right_quantile_title,
-                                 value=right_quantile * self._score_config.multiplier)
-
-                decision = "UNKNOWN"
-                if pvalue > 1.0 - self._score_config.score_level:
-                    if mean_diff > 0:
-                        decision = "GOOD"
-                    elif mean_diff < 0:
-                        decision = "BAD"
-                result.set_value(index=case, col="Decision", value=decision)
-
-                if self._score_config.overfit_overfit_iterations_info:
-                    test_iters = case_result.get_best_iterations()
-                    pvalue, statistic = calc_wilcoxon_test(baseline_iters, test_iters)
-
-                    result.set_value(index=case, col="Overfit iter diff", value=(test_iters - baseline_iters).mean())
-                    result.set_value(index=case, col="Overfit iter pValue", value=pvalue)
-
+        test_cases = [case for case in self._case_results if case != baseline_case]
+        self._warm_pairwise_wilcoxon(baseline_case, "scores", baseline_scores,
+                                     [(case, self._case_results[case].get_best_metrics()) for case in test_cases])
+        if self._score_config.overfit_overfit_iterations_info:
+            self._warm_pairwise_wilcoxon(baseline_case, "iterations", baseline_iters,
+                                         [(case, self._case_results[case].get_best_iterations()) for case in test_cases])
+
+        # folds are added in the same order for every case, so raw arrays can
+        # be compared without pandas index alignment
+        baseline_values = baseline_scores.values
+        inv_baseline_abs = None
+        if self._score_config.type == ScoreType.Rel:
+            # a zero baseline score yields an inf diff, as the pandas division
+            # did before, just without the divide-by-zero warning
+            with np.errstate(divide='ignore'):
+                inv_baseline_abs = 1.0 / np.abs(baseline_values)
+        sign = -1.0 if self._metric_description.is_max_optimal() else 1.0
+
+        case_count = len(test_cases)
+        pvalues = np.empty(case_count)
+        mean_diffs = np.empty(case_count)
+        left_quantiles = np.empty(case_count)
+        right_quantiles = np.empty(case_count)
+        overfit_diffs = np.empty(case_count)
+        overfit_pvalues = np.empty(case_count)
+
+        def compare_with_baseline(row, case):
+            case_result = self._case_results[case]
+            test_scores = case_result.get_best_metrics()
+            pvalue, statistic = self._calc_pairwise_wilcoxon(baseline_case, case, "scores",
+                                                             baseline_scores, test_scores)
+            pvalues[row] = pvalue
+
+            diff = sign * (baseline_values - test_scores.values)
+            if self._score_config.type == ScoreType.Rel:
+                diff *= inv_baseline_abs
+            mean_diffs[row] = diff.mean()
+
+            left_quantiles[row], right_quantiles[row] = calc_bootstrap_ci_for_mean(diff,
+                                                                                   self._score_config.interval_level)
+
+            if self._score_config.overfit_overfit_iterations_info:
+                test_iters = case_result.get_best_iterations()
+                pvalue, statistic = self._calc_pairwise_wilcoxon(baseline_case, case, "iterations",
+                                                                 baseline_iters, test_iters)
+                overfit_diffs[row] = (test_iters - baseline_iters).mean()
+                overfit_pvalues[row] = pvalue
+
+        if Parallel is not None and case_count > 1:
+            # comparisons are independent and the hot work runs in numpy/scipy
+            # code which releases the GIL, so threads are enough
+            Parallel(n_jobs=-1, prefer="threads", require="sharedmem")(
+                delayed(compare_with_baseline)(row, case) for (row, case) in enumerate(test_cases))
+        else:
+            for (row, case) in enumerate(test_cases):
+                compare_with_baseline(row, case)
+
+        decisions = np.where(pvalues > 1.0 - self._score_config.score_level,
+                             np.where(mean_diffs > 0, "GOOD", np.where(mean_diffs < 0, "BAD", "UNKNOWN")),
+                             "UNKNOWN")
+
+        multiplier = self._score_config.multiplier
+        left_quantile_title = "Quantile {}".format(self._score_config.score_level / 2)
+        right_quantile_title = "Quantile {}".format(1.0 - self._score_config.score_level / 2)
+
+        columns = [("PValue", pvalues),
+                   ("Score", mean_diffs * multiplier),
+                   (left_quantile_title, left_quantiles * multiplier),
+                   (right_quantile_title, right_quantiles * multiplier),
+                   ("Decision", decisions)]
+        if self._score_config.overfit_overfit_iterations_info:
+            columns.append(("Overfit iter diff", overfit_diffs))
+            columns.append(("Overfit iter pValue", overfit_pvalues))
+
+        result = pd.DataFrame(dict(columns), index=test_cases, columns=[title for (title, _) in columns])
         return result.sort_values(by=["Score"], ascending=self._metric_description.is_max_optimal())
 
     def get_baseline_case(self):
@@ -392,7 +556,7 @@ class MetricEvaluationResult:
         :param offset: first iteration to plot
         :return: plotly figure for all cases on specified fold
         """
-        import plotly.graph_objs as go
+        go = _get_plotly_graph_objs()
         traces = []
         for case in self.get_cases():
             case_result = self.get_case_result(case)
@@ -403,27 +567,13 @@ class MetricEvaluationResult:
                 first_idx = int(len(scores_curve) * 0.1)
 
             traces.append(
-                go.Scatter(x=[i * int(case_result.get_eval_step()) for i in range(first_idx, len(scores_curve))],
-                           y=scores_curve[first_idx:],
+                go.Scatter(x=np.arange(first_idx, len(scores_curve)) * int(case_result.get_eval_step()),
+                           y=np.asarray(scores_curve)[first_idx:],
                            mode='lines',
                            name='Case {}'.format(case)))
 
-        layout = go.Layout(
-            title='Learning curves for metric {} on fold #{}'.format(self._metric_description, fold),
-            hovermode='closest',
-            xaxis=dict(
-                title='Iteration',
-                ticklen=5,
-                zeroline=False,
-                gridwidth=2,
-            ),
-            yaxis=dict(
-                title='Metric',
-                ticklen=5,
-                gridwidth=2,
-            ),
-            showlegend=True
-        )
+        layout = _make_learning_curves_layout(
+            go, 'Learning curves for metric {} on fold #{}'.format(self._metric_description, fold))
         fig = go.Figure(data=traces, layout=layout)
         return fig
 